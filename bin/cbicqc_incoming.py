@@ -107,11 +107,11 @@ def acquisition_date(dcm_fname):
     # Default return date
     acq_date = '19010101'
 
-    if not os.path.isfile(dcm_fname):
-        print('* File not found - %s' % dcm_fname)
-
     try:
         ds = pydicom.read_file(dcm_fname, force=True)
+    except FileNotFoundError:
+        print('* File not found - %s' % dcm_fname)
+        raise
     except IOError:
         print("* Problem opening %s" % dcm_fname)
         raise
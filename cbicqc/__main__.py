@@ -32,9 +32,7 @@ SOFTWARE.
 import os
 import sys
 import argparse
-import pkg_resources
-
-from .cbicqc import CBICQC
+from importlib.metadata import version
 
 
 def main():
@@ -44,22 +42,37 @@ def main():
     parser.add_argument('-d', '--dir', default='.', help='BIDS QC dataset directory')
     parser.add_argument('-m', '--mode', default='phantom', help="QC Mode (phantom or live)")
     parser.add_argument('-p', '--past', default=12, type=int, help='Number of past months to summarize [12]')
-    parser.add_argument('--sub', default='', help='Subject ID')
-    parser.add_argument('--ses', default='', help='Session ID')
+    parser.add_argument('--sub', default='',
+                        help='Only process this subject ID (with or without sub- prefix) [all subjects]')
+    parser.add_argument('--ses', default='',
+                        help='Only process this session ID (with or without ses- prefix) [all sessions].'
+                             ' The phantom trend summary still uses all previously reported sessions')
     parser.add_argument('--no-sessions', action='store_true', default=False, help='Do not use session sub-directories')
+    parser.add_argument('--no-report', action='store_true', default=False,
+                        help='Skip all plots and PDF reports, including the phantom trend summary,'
+                             ' and save QC metrics only')
+    parser.add_argument('-j', '--n-jobs', default=1, type=int,
+                        help='Number of EPI timeseries to process in parallel [1]')
 
     # Parse command line arguments
     args = parser.parse_args()
 
-    bids_dir = os.path.realpath(args.dir)
+    # Only resolve relative or non-normalized paths - avoids per-component lstat calls on deep network mounts
+    if os.path.isabs(args.dir) and '..' not in args.dir.split(os.sep):
+        bids_dir = args.dir
+    else:
+        bids_dir = os.path.realpath(args.dir)
+
     mode = args.mode
     past_months = args.past
     subj_id = args.sub
     sess_id = args.ses
     no_sessions = args.no_sessions
+    no_report = args.no_report
+    n_jobs = args.n_jobs
 
-    # Read version from setup.py
-    ver = pkg_resources.get_distribution('cbicqc').version
+    # Read version from installed package metadata
+    ver = version('cbicqc')
 
     # Splash
     print('')
@@ -79,8 +92,13 @@ def main():
     if 'phantom' in mode:
         print('Summary : {} months'.format(past_months))
 
+    # Deferred heavy import (numpy, scipy, matplotlib, reportlab, etc) so --help
+    # and argument errors return without loading the analysis stack
+    from .cbicqc import CBICQC
+
     # Setup QC analysis
-    qc = CBICQC(bids_dir=bids_dir, subject=subj_id, session=sess_id, mode=mode, past_months=past_months, no_sessions=no_sessions)
+    qc = CBICQC(bids_dir=bids_dir, subject=subj_id, session=sess_id, mode=mode, past_months=past_months,
+                no_sessions=no_sessions, no_report=no_report, n_jobs=n_jobs)
 
     # Run analysis
     qc.run()
@@ -35,9 +35,9 @@ SOFTWARE.
 """
 
 import os
+import re
 import sys
 import json
-import tempfile
 import shutil
 import numpy as np
 import nibabel as nb
@@ -45,8 +45,7 @@ import datetime as dt
 import pandas as pd
 from glob import glob
 from pathlib import Path
-
-import bids
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from .timeseries import temporal_mean_sd, extract_timeseries, detrend_timeseries
 from .graphics import (plot_roi_timeseries, plot_roi_powerspec,
@@ -56,21 +55,31 @@ from .graphics import (plot_roi_timeseries, plot_roi_powerspec,
 from .rois import register_template, make_rois
 from .metrics import signal_metrics, moco_metrics
 from .moco import moco_phantom, moco_live, moco_postprocess
-from .report import ReportPDF
-from .summary import Summarize
+
+
+# BIDS subject and session entities in a filename
+BIDS_SUB_RE = re.compile(r'(?:^|_)sub-([a-zA-Z0-9]+)')
+BIDS_SES_RE = re.compile(r'(?:^|_)ses-([a-zA-Z0-9]+)')
 
 
 class CBICQC:
 
-    def __init__(self, bids_dir, subject='', session='', mode='phantom', past_months=12, no_sessions=False):
+    def __init__(self, bids_dir, subject='', session='', mode='phantom', past_months=12, no_sessions=False,
+                 no_report=False, n_jobs=1):
 
         # Copy arguments into object
         self._bids_dir = Path(bids_dir)
-        self._subject = subject
-        self._session = session
+        # Accept IDs with or without their BIDS entity prefix (01 or sub-01)
+        self._subject = subject[4:] if subject.startswith('sub-') else subject
+        self._session = session[4:] if session.startswith('ses-') else session
         self._mode = mode
         self._past_months = past_months
         self._no_sessions = no_sessions
+        self._no_report = no_report
+        self._n_jobs = n_jobs
+
+        # Phantom moco threads per series [None = ThreadPoolExecutor default]
+        self._moco_threads = None
 
         # Phantom or in vivo suffix ('T2star' or 'bold')
         self._suffix = 'T2star' if 'phantom' in mode else 'bold'
@@ -81,9 +90,6 @@ class CBICQC:
         self._this_epits_fpath = ''
         self._this_epits_stub = ''
 
-        # BIDS layout
-        self._layout = None
-
         # Create work and report directories
         # Individual subject/session folders created during runtime
         self._work_dir = self._bids_dir / 'work' / 'cbicqc'
@@ -98,10 +104,11 @@ class CBICQC:
         self._report_json = ''
 
         # Working directory intermediate filenames
-        self._tmean_fname = 'tmean.nii.gz'
-        self._tsd_fname = 'tsd.nii.gz'
-        self._tsfnr_fname = 'tsfnr.nii.gz'
-        self._roi_labels_fname = 'roi_labels.nii.gz'
+        # Uncompressed - retained for inspection only and never read back by CBICQC, so gzip is pure overhead
+        self._tmean_fname = 'tmean.nii'
+        self._tsd_fname = 'tsd.nii'
+        self._tsfnr_fname = 'tsfnr.nii'
+        self._roi_labels_fname = 'roi_labels.nii'
 
         # Working directory report images
         self._roi_ts_png = 'roi_timeseries.png'
@@ -129,67 +136,50 @@ class CBICQC:
         # Get complete list of EPI time series for this subject
         # Use _bold.nii.gz suffix to identify time series for now
         # TODO: Broaden search for non-BOLD series
-        epits_list = self._get_epits_list()
+        # Force magnitude-only quality control
+        print('Magnitude image quality control')
+
+        # QC processing is restricted to the requested subject and session
+        epits_list = self._get_epits_list(self._subject, self._session)
 
         if len(epits_list) < 1:
             print(f'*** No EPI timeseries found in {self._bids_dir}')
 
-        # Init list of session metrics for this subject
-        metric_list = []
-
-        # Loop over all EPI timeseries images
-        for epits_fpath in epits_list:
-
-            self._this_epits_fpath = epits_fpath
-
-            # Parse image filename for BIDS keys
-            bids_dict = bids.layout.parse_file_entities(epits_fpath)
-            self._this_subject = bids_dict['subject']
-
-            if 'session' in bids_dict:
-                self._this_session = bids_dict['session']
-            else:
-                self._this_session = 'None'
-
-            # Extract EPI series prefix (basename without extensions)
-            epits_prefix = os.path.basename(epits_fpath).replace('.nii.gz', '').replace('.nii', '')
-
-            # Create work and report folders for this EPI timeseries
-            self._epits_work_dir = self._work_dir / epits_prefix
-            os.makedirs(self._epits_work_dir, exist_ok=True)
-            self._epits_report_dir = self._report_dir / epits_prefix
-            os.makedirs(self._epits_report_dir, exist_ok=True)
-
-            print('')
-            print('    EPI timeseries {}'.format(epits_prefix))
-
-            # Report PDF and JSON filenames - used in both report and summarize modes
-            self._report_pdf = self._epits_report_dir / f'{epits_prefix}_qc.pdf'
-            self._report_json = self._epits_report_dir / f'{epits_prefix}_qc.json'
-
-            if os.path.isfile(self._report_pdf) and os.path.isfile(self._report_json):
-
-                # QC analysis and reporting already run
-                print('      Report and metadata detected for this session - skipping')
-
-            else:
+        # Process each EPI timeseries, returning its report JSON filename
+        # Series are fully independent, so optionally fan out over worker processes.
+        # Each worker receives its own copy of this object, so per-series state does not collide
+        if self._n_jobs > 1 and len(epits_list) > 1:
+            # Split the cores between workers so per-volume moco threads don't oversubscribe the machine
+            self._moco_threads = max(1, (os.cpu_count() or 1) // self._n_jobs)
+            with ProcessPoolExecutor(max_workers=self._n_jobs) as pool:
+                report_json_list = list(pool.map(self._process_epits, epits_list))
+        else:
+            report_json_list = [self._process_epits(epits_fpath) for epits_fpath in epits_list]
 
-                # QC analysis and report generation
-                self._analyze_and_report()
+        # Trend summary covers every session of the subject, not just the session requested with --ses
+        # Include all previously reported series so a single-session run does not truncate the history
+        if self._session:
+            all_json_list = [self._report_json_fname(f) for f in self._get_epits_list(self._subject, '')]
+            report_json_list = [f for f in all_json_list if os.path.isfile(f)]
 
-            # Add metrics for this subject/session to cumulative list
-            metric_list.append(self._get_metrics())
+        # Load metrics for all subjects/sessions
+        # Many small independent file reads, so overlap IO latency with a thread pool
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            metric_list = list(pool.map(self._get_metrics, report_json_list))
 
         # Convert metric list to dataframe and save to file
         self._metrics_df = pd.DataFrame(metric_list)
 
         # Generate summary report for phantom QC only
-        if 'phantom' in self._mode:
+        # Metrics-only runs skip the trend plots and summary PDF along with the per-series reports
+        if 'phantom' in self._mode and not self._no_report:
 
             # Check for deidentified BIDS data
             # dcm2niix with anonymization on by default generates AcquisitionTime but not AcquisitionDateTime
             # Use "bidskit --no-anon" to skip deidentification and generate AcquisitionDataTime in the JSON sidecars
             if 'AcquisitionDateTime' in self._metrics_df:
+                # Deferred import - summary pulls in scikit-learn, only needed for phantom trends
+                from .summary import Summarize
                 Summarize(self._report_dir, self._metrics_df, self._past_months)
             else:
                 print('')
@@ -201,6 +191,68 @@ class CBICQC:
         # Cleanup work directory
         self.cleanup(retain=True)
 
+    def _process_epits(self, epits_fpath):
+        """
+        Run QC analysis and reporting for a single EPI timeseries if not already done
+
+        :param epits_fpath: str, EPI timeseries image path
+        :return: Path, report JSON filename for this timeseries
+        """
+
+        self._this_epits_fpath = epits_fpath
+
+        # Parse image filename for BIDS keys
+        # Only subject and session are needed - avoids importing and configuring all of pybids
+        self._this_subject, self._this_session = self.parse_filename(epits_fpath)
+
+        if self._this_session == 'Unknown':
+            self._this_session = 'None'
+
+        epits_prefix = self._epits_prefix(epits_fpath)
+
+        # Work and report folders for this EPI timeseries
+        self._epits_work_dir = self._work_dir / epits_prefix
+        self._epits_report_dir = self._report_dir / epits_prefix
+
+        print('')
+        print('    EPI timeseries {}'.format(epits_prefix))
+
+        # Report PDF and JSON filenames - used in both report and summarize modes
+        self._report_pdf = self._epits_report_dir / f'{epits_prefix}_qc.pdf'
+        self._report_json = self._report_json_fname(epits_fpath)
+
+        # Check JSON first - absent for any series not yet analyzed, so one stat decides most cases
+        # PDF report not required in metrics-only mode
+        report_done = os.path.isfile(self._report_json) and (self._no_report or os.path.isfile(self._report_pdf))
+
+        if report_done:
+
+            # QC analysis and reporting already run
+            print('      Report and metadata detected for this session - skipping')
+
+        else:
+
+            # Create work and report folders only when analysis is actually run
+            os.makedirs(self._epits_work_dir, exist_ok=True)
+            os.makedirs(self._epits_report_dir, exist_ok=True)
+
+            # QC analysis and report generation
+            self._analyze_and_report()
+
+        return self._report_json
+
+    @staticmethod
+    def _epits_prefix(epits_fpath):
+
+        # Extract EPI series prefix (basename without extensions)
+        return os.path.basename(epits_fpath).replace('.nii.gz', '').replace('.nii', '')
+
+    def _report_json_fname(self, epits_fpath):
+
+        # Report JSON for an EPI timeseries in derivatives
+        epits_prefix = self._epits_prefix(epits_fpath)
+        return self._report_dir / epits_prefix / f'{epits_prefix}_qc.json'
+
     def _analyze_and_report(self):
 
         img_fname = self._this_epits_fpath
@@ -276,47 +328,87 @@ class CBICQC:
         # Add image meta data into metrics dictionary
         metrics.update(meta)
 
-        # Time vector (seconds)
-        t = np.arange(0, s_mean_t.shape[1]) * meta['RepetitionTime']
-
-        print('      Generating Report')
-
-        # Create report images
-        plot_roi_timeseries(t, s_mean_t, s_detrend_t, s_fit_t, self._epits_work_dir / self._roi_ts_png)
-        plot_roi_powerspec(t, s_detrend_t, self._epits_work_dir / self._roi_ps_png)
-        plot_mopar_timeseries(epits_moco_df, self._epits_work_dir / self._mopar_ts_png)
-        plot_mopar_powerspec(epits_moco_df, self._epits_work_dir / self._mopar_pspec_png)
-        roi_demeaned_ts(epits_moco_nii, rois_nii, self._epits_work_dir / self._rois_demeaned_png)
-        orthoslices(tmean_nii, self._epits_work_dir / self._tmean_montage_png, cmap='gray', irng='robust')
-        orthoslices(tsd_nii, self._epits_work_dir / self._tsd_montage_png, cmap='viridis', irng='robust')
-        orthoslices(rois_nii, self._epits_work_dir / self._rois_montage_png, cmap='Pastel1', irng='noscale')
-
         # OPTIONAL: Save intermediate images
+        # Write in a background thread to overlap file I/O with drawing the report images
+        # Plotting itself stays on this thread since pyplot state is not thread-safe
+        save_pool = None
+        save_jobs = []
         if self._save_intermediates:
-            nb.save(tmean_nii, self._epits_work_dir / self._tmean_fname)
-            nb.save(tsd_nii, self._epits_work_dir / self._tsd_fname)
-            nb.save(rois_nii, self._epits_work_dir / self._roi_labels_fname)
-            nb.save(tsfnr_nii, self._epits_work_dir / self._tsfnr_fname)
-
-        # Construct filename dictionary to pass to PDF generator
-        fnames = dict(WorkDir=self._epits_work_dir,
-                      ReportPDF=self._report_pdf,
-                      ReportJSON=self._report_json,
-                      ROITimeseries=self._epits_work_dir / self._roi_ts_png,
-                      ROIPowerspec=self._epits_work_dir / self._roi_ps_png,
-                      MoparTimeseries=self._epits_work_dir / self._mopar_ts_png,
-                      MoparPowerspec=self._epits_work_dir / self._mopar_pspec_png,
-                      TMeanMontage=self._epits_work_dir / self._tmean_montage_png,
-                      TSDMontage=self._epits_work_dir / self._tsd_montage_png,
-                      ROIsMontage=self._epits_work_dir / self._rois_montage_png,
-                      ROIDemeanedTS=self._epits_work_dir / self._rois_demeaned_png,
-                      TMean=self._epits_work_dir / self._tmean_fname,
-                      TSD=self._epits_work_dir / self._tsd_fname,
-                      ROILabels=self._epits_work_dir / self._roi_labels_fname)
+            save_pool = ThreadPoolExecutor(max_workers=1)
+            for inter_nii, inter_fname in [(tmean_nii, self._tmean_fname),
+                                           (tsd_nii, self._tsd_fname),
+                                           (rois_nii, self._roi_labels_fname),
+                                           (tsfnr_nii, self._tsfnr_fname)]:
+                save_jobs.append(save_pool.submit(nb.save, inter_nii, self._epits_work_dir / inter_fname))
+
+        # Saves are always joined, even if plotting fails
+        try:
+            # Headless batch mode - skip all plotting and PDF generation
+            if self._no_report:
+                print('      Saving QC metrics only')
+                self._save_metrics(metrics)
+                return
+
+            # Time vector (seconds)
+            t = np.arange(0, s_mean_t.shape[1]) * meta['RepetitionTime']
+
+            print('      Generating Report')
+
+            # Construct filename dictionary once - used for plotting and passed to PDF generator
+            work_dir = self._epits_work_dir
+            fnames = dict(WorkDir=work_dir,
+                          ReportPDF=self._report_pdf,
+                          ReportJSON=self._report_json,
+                          ROITimeseries=work_dir / self._roi_ts_png,
+                          ROIPowerspec=work_dir / self._roi_ps_png,
+                          MoparTimeseries=work_dir / self._mopar_ts_png,
+                          MoparPowerspec=work_dir / self._mopar_pspec_png,
+                          TMeanMontage=work_dir / self._tmean_montage_png,
+                          TSDMontage=work_dir / self._tsd_montage_png,
+                          ROIsMontage=work_dir / self._rois_montage_png,
+                          ROIDemeanedTS=work_dir / self._rois_demeaned_png,
+                          TMean=work_dir / self._tmean_fname,
+                          TSD=work_dir / self._tsd_fname,
+                          ROILabels=work_dir / self._roi_labels_fname)
+
+            # Create report images
+            plot_roi_timeseries(t, s_mean_t, s_detrend_t, s_fit_t, fnames['ROITimeseries'])
+            plot_roi_powerspec(t, s_detrend_t, fnames['ROIPowerspec'])
+            plot_mopar_timeseries(epits_moco_df, fnames['MoparTimeseries'])
+            plot_mopar_powerspec(epits_moco_df, fnames['MoparPowerspec'])
+            roi_demeaned_ts(epits_moco_nii, rois_nii, fnames['ROIDemeanedTS'])
+
+            # Last use of the 4D moco series - release its data array before montages and PDF build
+            epits_moco_nii.uncache()
+            del epits_moco_nii
+            orthoslices(tmean_nii, fnames['TMeanMontage'], cmap='gray', irng='robust')
+            orthoslices(tsd_nii, fnames['TSDMontage'], cmap='viridis', irng='robust')
+            orthoslices(rois_nii, fnames['ROIsMontage'], cmap='Pastel1', irng='noscale')
+        finally:
+            # Intermediate images must be complete before the report is built
+            self._wait_for_saves(save_pool, save_jobs)
 
         # Build PDF report
+        # Deferred import - reportlab not needed in metrics-only mode
+        from .report import ReportPDF
         ReportPDF(fnames, meta, metrics)
 
+    @staticmethod
+    def _wait_for_saves(save_pool, save_jobs):
+        """
+        Wait for background image saves to finish, re-raising any write errors
+
+        :param save_pool: ThreadPoolExecutor, background save pool or None if nothing was saved
+        :param save_jobs: list, Futures returned by save_pool.submit
+        """
+
+        if save_pool is None:
+            return
+
+        save_pool.shutdown(wait=True)
+        for job in save_jobs:
+            job.result()
+
     def cleanup(self, retain=False):
 
         if retain:
@@ -352,7 +444,7 @@ class CBICQC:
 
             if 'phantom' in self._mode:
 
-                moco_nii, moco_pars = moco_phantom(img_nii)
+                moco_nii, moco_pars = moco_phantom(img_nii, n_workers=self._moco_threads)
 
             elif 'live' in self._mode:
 
@@ -370,9 +462,16 @@ class CBICQC:
 
         return moco_nii, moco_df
 
-    def _get_metrics(self):
+    def _save_metrics(self, metrics):
+
+        # Save metrics in derivatives as JSON file
+        with open(self._report_json, 'w') as fd:
+            json.dump(metrics, fd, sort_keys=True, indent=4)
+
+    @staticmethod
+    def _get_metrics(report_json):
 
-        with open(self._report_json, 'r') as fd:
+        with open(report_json, 'r') as fd:
             metrics = json.load(fd)
 
         return metrics
@@ -382,24 +481,39 @@ class CBICQC:
         tmp_list = glob(os.path.join(self._bids_dir, 'sub-*'))
         return [os.path.basename(d).replace('sub-', '') for d in tmp_list]
 
-    def _get_epits_list(self):
+    def _get_epits_list(self, subject='', session=''):
+        """
+        Find magnitude EPI timeseries, optionally restricted to one subject and/or session
+
+        :param subject: str, subject ID without 'sub-' prefix ['' : all subjects]
+        :param session: str, session ID without 'ses-' prefix ['' : all sessions]
+        :return: list, sorted EPI timeseries image paths
+        """
+
+        # Restrict search to requested subject and session folders rather than scanning all of them
+        sub_dir = f'sub-{subject}' if subject else 'sub-*'
+        ses_dir = f'ses-{session}' if session else 'ses-*'
+
+        if self._no_sessions:
+            func_dir = os.path.join(self._bids_dir, sub_dir, 'func')
+        else:
+            func_dir = os.path.join(self._bids_dir, sub_dir, ses_dir, 'func')
 
-        # Force magnitude-only quality control
         # Check for presence of BOLD phase images. If they're present, add part-mag tag
         # to avoid running CBICQC on phase images (which won't work)
-        print('Magnitude image quality control')
-        phase_list = glob(os.path.join(self._bids_dir, 'sub-*', 'ses-*', 'func', '*part-phase*_bold.nii*'))
+        phase_list = glob(os.path.join(func_dir, '*part-phase*_bold.nii*'))
         if len(phase_list) > 0:
             part_tag = 'part-mag*'
         else:
             part_tag = ''
 
         if self._no_sessions:
-            epits_list = glob(os.path.join(self._bids_dir, 'sub-*', 'func', f'*{part_tag}*_bold.nii.gz'))
+            epits_list = glob(os.path.join(func_dir, f'*{part_tag}*_bold.nii.gz'))
         else:
-            epits_list = glob(os.path.join(self._bids_dir, 'sub-*', 'ses-*', 'func', f'*{part_tag}_bold.nii.gz'))
+            epits_list = glob(os.path.join(func_dir, f'*{part_tag}_bold.nii.gz'))
 
-        return epits_list
+        # Deterministic processing order across filesystems
+        return sorted(epits_list)
 
     @staticmethod
     def default_metadata():
@@ -416,21 +530,11 @@ class CBICQC:
 
         bname = os.path.basename(fname)
 
-        # Split at underscores
-        keyvals = bname.split('_')
-
-        subject, session = 'Unknown', 'Unknown'
-
-        for kv in keyvals:
-
-            if '-' in kv and len(kv) >= 3:
-
-                k, v = kv.split('-')
+        sub_match = BIDS_SUB_RE.search(bname)
+        ses_match = BIDS_SES_RE.search(bname)
 
-                if 'sub' in k:
-                    subject = v
-                if 'ses' in k:
-                    session = v
+        subject = sub_match.group(1) if sub_match else 'Unknown'
+        session = ses_match.group(1) if ses_match else 'Unknown'
 
         return subject, session
 
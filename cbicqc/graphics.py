@@ -25,10 +25,14 @@ Copyright 2019 California Institute of Technology.
 """
 
 import numpy as np
+
+# Headless, file-only plotting - select Agg before pyplot to skip GUI backend probing
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
 
 from scipy.signal import periodogram
-from skimage.util import montage
 from skimage.exposure import rescale_intensity
 import pandas as pd
 from datetime import date
@@ -66,14 +70,16 @@ def plot_roi_timeseries(t, s_mean_t, s_fit_t, s_detrend_t, plot_fname):
     handles, labels = axs[2].get_legend_handles_labels()
     fig.legend(handles, labels, loc='upper center', ncol=3)
 
-    # Space subplots without title overlap
-    plt.tight_layout()
+    # Fixed margins for the shared 10 x 5 inch line plot layout - avoids the tight_layout solver
+    # Leave headroom above the first subplot for the figure legend
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.1, top=0.86, hspace=0.45)
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    # Line plots are embedded 7 inches wide in the PDF report, so 150 dpi still gives ~215 ppi
+    fig.savefig(plot_fname, dpi=150, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
 
 def plot_roi_powerspec(t, s_detrend_t, plot_fname):
@@ -117,14 +123,14 @@ def plot_roi_powerspec(t, s_detrend_t, plot_fname):
     # Add x label to final subplot
     axs[2].set_xlabel('Frequency (Hz)')
 
-    # Space subplots without title overlap
-    plt.tight_layout()
+    # Fixed margins for the shared 10 x 5 inch line plot layout
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.1, top=0.94, hspace=0.45)
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    fig.savefig(plot_fname, dpi=150, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
 
 def plot_mopar_timeseries(moco_df, plot_fname):
@@ -158,14 +164,14 @@ def plot_mopar_timeseries(moco_df, plot_fname):
     )
     axs[1].grid(color='gray', linestyle=':', linewidth=1)
 
-    # Space subplots without title overlap
-    plt.tight_layout()
+    # Fixed margins for the shared 10 x 5 inch line plot layout
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.1, top=0.94, hspace=0.45)
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    fig.savefig(plot_fname, dpi=150, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
 
 def plot_mopar_powerspec(moco_df, plot_fname):
@@ -224,29 +230,35 @@ def plot_mopar_powerspec(moco_df, plot_fname):
     # Add x axis label to last subplot
     axs[1].set_xlabel('Frequency (Hz)')
 
-    # Space subplots without title overlap
-    plt.tight_layout()
+    # Fixed margins for the shared 10 x 5 inch line plot layout
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.1, top=0.94, hspace=0.45)
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    fig.savefig(plot_fname, dpi=150, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
 
 def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default'):
 
-    img3d = img_nii.get_fdata()
+    # Intensity limits need the whole volume, but single precision is ample for display
+    img3d = img_nii.get_fdata(dtype=np.float32)
+
+    # Look up colormap once for all three sections
+    cmap = plt.get_cmap(cmap)
 
     # Intensity scaling
     if 'robust' in irng:
         vmin, vmax = np.percentile(img3d, (1, 99))
     elif 'noscale' in irng:
-        nc = plt.get_cmap(cmap).N
-        vmin, vmax = 0, nc
+        vmin, vmax = 0, cmap.N
     else:
         vmin, vmax = np.min(img3d), np.max(img3d)
 
+    # Shared intensity mapping for all sections and the colorbar
+    norm = Normalize(vmin=vmin, vmax=vmax)
+
     fig, axs = plt.subplots(1, 3, figsize=(7, 2.4), constrained_layout=True)
 
     nx, ny, nz = img3d.shape
@@ -261,8 +273,8 @@ def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default'):
     # Use transverse image for colorbar reference
     trafig = axs[0].imshow(
         m_tra,
-        cmap=plt.get_cmap(cmap),
-        vmin=vmin, vmax=vmax,
+        cmap=cmap,
+        norm=norm,
         aspect='equal',
         origin='lower'
     )
@@ -271,8 +283,8 @@ def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default'):
 
     axs[1].imshow(
         m_cor,
-        cmap=plt.get_cmap(cmap),
-        vmin=vmin, vmax=vmax,
+        cmap=cmap,
+        norm=norm,
         aspect='equal',
         origin='lower'
     )
@@ -281,21 +293,21 @@ def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default'):
 
     axs[2].imshow(
         m_sag,
-        cmap=plt.get_cmap(cmap),
-        vmin=vmin, vmax=vmax,
+        cmap=cmap,
+        norm=norm,
         aspect='equal',
         origin='lower'
     )
     axs[2].set_title('Sagittal')
     axs[2].axis('off')
 
-    plt.colorbar(trafig, ax=axs, location='right', shrink=0.75)
+    fig.colorbar(trafig, ax=axs, location='right', shrink=0.75)
 
     # Save plot to file
-    plt.savefig(ortho_fname, dpi=300)
+    fig.savefig(ortho_fname, dpi=300, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
     return ortho_fname
 
@@ -304,23 +316,39 @@ def orthoslice_montage(img_nii, montage_fname, cmap='viridis', irng='default'):
 
     orient_name = ['Axial', 'Coronal', 'Sagittal']
 
-    img3d = img_nii.get_fdata()
+    # Only 9 slices per orientation are displayed, so read those from the image proxy
+    # rather than loading the full volume
+    dataobj = img_nii.dataobj
 
-    plt.subplots(1, 3, figsize=(7, 2.4))
+    # Look up colormap once for all three montages
+    cmap = plt.get_cmap(cmap)
+
+    fig, axs = plt.subplots(1, 3, figsize=(7, 2.4))
 
     for ax in [0, 1, 2]:
 
         # Transpose dimensions for given orientation
         ax_order = np.roll([2, 0, 1], ax)
-        s = np.transpose(img3d, ax_order)
 
-        # Downsample to 9 images in first dimension
-        nx = s.shape[0]
+        # Downsample to 9 images in first transposed dimension
+        dim = ax_order[0]
+        nx = img_nii.shape[dim]
         xx = np.linspace(0, nx-1, 9).astype(int)
-        s = s[xx, :, :]
+
+        # Remaining in-plane dimensions reordered to match the transposed volume
+        in_plane = [d for d in range(3) if d != dim]
+        perm = [in_plane.index(d) for d in ax_order[1:]]
+
+        s = np.empty([9] + [img_nii.shape[d] for d in ax_order[1:]], dtype=np.float32)
+        for sc, x in enumerate(xx):
+            slicer = [slice(None)] * 3
+            slicer[dim] = x
+            s[sc] = np.transpose(np.asarray(dataobj[tuple(slicer)], dtype=np.float32), perm)
 
         # Construct 3x3 montage of slices
-        m2d = montage(s, fill='mean', grid_shape=(3, 3))
+        # Exact tiling of equal-sized slices, so a reshape replaces skimage montage padding and fill
+        _, h, w = s.shape
+        m2d = s.reshape(3, 3, h, w).swapaxes(1, 2).reshape(3 * h, 3 * w)
 
         # Intensity scaling
         if 'default' in irng:
@@ -332,24 +360,21 @@ def orthoslice_montage(img_nii, montage_fname, cmap='viridis', irng='default'):
             # Do nothing
             pass
 
-        plt.subplot(1, 3, ax+1)
-        plt.imshow(m2d,
-                   cmap=plt.get_cmap(cmap),
-                   aspect='equal',
-                   origin='lower')
-        plt.title(orient_name[ax])
-
-        plt.axis('off')
-        plt.subplots_adjust(bottom=0.0, top=0.9, left=0.0, right=1.0)
+        axs[ax].imshow(m2d,
+                       cmap=cmap,
+                       aspect='equal',
+                       origin='lower')
+        axs[ax].set_title(orient_name[ax])
+        axs[ax].axis('off')
 
     # Remove excess space
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(montage_fname, dpi=300)
+    fig.savefig(montage_fname, dpi=300, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
 
 def roi_demeaned_ts(img_nii, rois_nii, residuals_fname):
@@ -372,8 +397,10 @@ def roi_demeaned_ts(img_nii, rois_nii, residuals_fname):
 
     roi_name = ['Air', 'Nyquist Ghost', 'Signal']
 
-    rois = rois_nii.get_fdata()
-    s = img_nii.get_fdata()
+    rois = np.asanyarray(rois_nii.dataobj)
+
+    # Same dtype as timeseries module to reuse the cached image array
+    s = img_nii.get_fdata(dtype=np.float32)
 
     # Number of time points and labels
     nt = s.shape[3]
@@ -418,44 +445,51 @@ def roi_demeaned_ts(img_nii, rois_nii, residuals_fname):
         axs[lc].set_axis_off()
 
     # Adjust space around plots
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(residuals_fname, dpi=300)
+    fig.savefig(residuals_fname, dpi=300, pil_kwargs={'compress_level': 1})
 
     # Close plot
-    plt.close()
+    plt.close(fig)
 
 
-def metric_trend_plot(mc, metric_name, metrics_df, gridspec, past_months=12):
+def metric_trend_plot(axs, metric_name, metrics_df, past_months=12, t_range=None, pcts=None):
     """
     Plot session metric trend with median, 5th and 95th percentiles
     Add metric histogram at right
 
-    :param mc: int, index of metric to plot
+    :param axs: tuple, (trend, histogram) axes pair sharing a y axis
     :param metric_name: str, metric name to plot
     :param metrics_df: DataFrame, complete metric dataframe for current subject
-    :param gridspec: GridSpec, pyplot grid specification
     :param past_months: int, number of past months to plot
+    :param t_range: tuple, precomputed (start, end) Timestamps, overrides past_months
+    :param pcts: array, precomputed 5th, 50th and 95th metric percentiles
     :return:
     """
 
     # Extract subframe for this metric timeseries
     df = metrics_df[['Date', metric_name, 'Outlier']]
 
-    t1 = pd.Timestamp(date.today())
-    t0 = t1 - pd.DateOffset(months=past_months)
+    if t_range is None:
+        t1 = pd.Timestamp(date.today())
+        t0 = t1 - pd.DateOffset(months=past_months)
+    else:
+        t0, t1 = t_range
+
+    # Only scatter sessions inside the plotted window
+    in_window = df['Date'] >= t0
 
-    ax0 = plt.subplot(gridspec[mc, 0])
+    ax0, ax1 = axs
 
     marker_dict = {'Outlier': 'x', 'Inlier': 'o'}
     color_dict = {'Outlier': 'red', 'Inlier': 'palegreen'}
 
     for kind in marker_dict:
 
-        inds = df['Outlier'] == kind
-        xx = df[inds]['Date']
-        yy = df[inds][metric_name]
+        inds = in_window & (df['Outlier'] == kind)
+        xx = df.loc[inds, 'Date']
+        yy = df.loc[inds, metric_name]
 
         ax0.scatter(
             x=xx,
@@ -470,13 +504,14 @@ def metric_trend_plot(mc, metric_name, metrics_df, gridspec, past_months=12):
     ax0.yaxis.label.set_size(14)
 
     # Calculate metric limits and 5/95 percentiles
-    p5, p50, p95 = np.percentile(df[metric_name].values, (5, 50, 95))
+    if pcts is None:
+        pcts = np.percentile(df[metric_name].values, (5, 50, 95))
+    p5, p50, p95 = pcts
 
-    ax0.plot([t0, t1], [p5, p5], 'g:')
-    ax0.plot([t0, t1], [p50, p50], 'g')
-    ax0.plot([t0, t1], [p95, p95], 'g:')
+    ax0.axhline(p5, color='g', ls=':')
+    ax0.axhline(p50, color='g')
+    ax0.axhline(p95, color='g', ls=':')
 
-    ax1 = plt.subplot(gridspec[mc, 1], sharey=ax0)
     df.hist(
         column=metric_name,
         grid=False,
@@ -70,33 +70,45 @@ def signal_metrics(fit_results, tsfnr_nii, rois_nii):
 
     metrics['NoiseSigma'] = air_mean * np.sqrt(np.pi/2)
     metrics['NoiseFloor'] = air_mean
-    metrics['SignalSpikes'] = spike_count(fit_results[0].fun)
-    metrics['NyquistSpikes'] = spike_count(fit_results[1].fun)
-    metrics['AirSpikes'] = spike_count(fit_results[2].fun)
+
+    # Spike counts for all ROI residuals in a single pass
+    spikes = spike_count(np.column_stack([res.fun for res in fit_results]))
+
+    metrics['SignalSpikes'] = spikes[0]
+    metrics['NyquistSpikes'] = spikes[1]
+    metrics['AirSpikes'] = spikes[2]
 
     return metrics
 
 
 def spike_count(points, thresh=3.5):
     """
+    Count outliers using the MAD-based modified z-score
 
-    :param points:
-    :param thresh:
-    :return:
+    :param points: array, timeseries (nt) or column timeseries (nt x n)
+    :param thresh: float, modified z-score threshold
+    :return: int or list of ints, spike count for each timeseries
     """
 
-    if len(points.shape) == 1:
+    is_1d = len(points.shape) == 1
+
+    if is_1d:
         points = points[:, None]
 
-    # Median absolute deviation from the median (MAD)
+    # Median absolute deviation from the median (MAD) for each column
     med = np.median(points, axis=0)
     dev = np.abs(points - med)
-    mad = np.median(dev)
+    mad = np.median(dev, axis=0)
 
     modified_z_score = 0.6745 * dev / mad
 
+    counts = np.sum(modified_z_score > thresh, axis=0)
+
     # Cast to int to prevent JSON encoding errors later
-    return int(np.sum(modified_z_score > thresh))
+    if is_1d:
+        return int(counts[0])
+
+    return [int(c) for c in counts]
 
 
 def calc_tsfnr(tsfnr_nii, rois_nii):
@@ -115,10 +127,11 @@ def calc_tsfnr(tsfnr_nii, rois_nii):
     :return:
     """
 
-    tsfnr_img = tsfnr_nii.get_fdata()
-    rois_img = rois_nii.get_fdata()
+    # Use stored arrays directly - only signal ROI voxels are needed, so skip get_fdata's cached float64 copy
+    tsfnr_img = np.asanyarray(tsfnr_nii.dataobj)
+    rois_img = np.asanyarray(rois_nii.dataobj)
 
-    return np.median(tsfnr_img[rois_img == 3])
+    return float(np.median(tsfnr_img[rois_img == 3]))
 
 
 def moco_metrics(moco_df):
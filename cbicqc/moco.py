@@ -25,60 +25,87 @@ Copyright 2019 California Institute of Technology.
 """
 
 import os
+import shutil
 import subprocess
+from functools import lru_cache
 import numpy as np
 import nibabel as nb
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
-from scipy.ndimage.measurements import center_of_mass
 from scipy.ndimage import shift
-from scipy.spatial.transform import Rotation
 from scipy import signal
 
 
-def moco_phantom(img_nii):
+def moco_phantom(img_nii, n_workers=None, min_shift=0.01):
     """
     Spherical QC phantom requires simpler registration approach.
     Use center of mass registration only.
 
     :param img_nii: Nifti object,
         4D QC time series
+    :param n_workers: int,
+        Number of volume registration threads [ThreadPoolExecutor default]
+    :param min_shift: float,
+        Largest CoM displacement (voxels) left uncorrected [0.01]
     :return moco_nii: Nifti object,
         Motion corrected 4D QC time series
     :return moco_pars: array,
         Motion parameter array (nt x 6)
     """
 
-    img = img_nii.get_fdata()
+    # Don't cache the float array in the source image - only needed here
+    # float32 is ample for integer scanner data and halves memory traffic
+    img = img_nii.get_fdata(dtype=np.float32, caching='unchanged')
     nt = img.shape[3]
     vox_mm = img_nii.header.get('pixdim')[1:4]
 
     # Clip intensity range to 1st, 99th percentile for robust CoM
-    p1, p99 = np.percentile(img, (1, 99))
-    img_clip = np.clip(img, p1, p99)
+    # Percentiles are stable on a strided subsample - avoids partitioning a copy of the full 4D array
+    p1, p99 = np.percentile(img[::2, ::2, ::2, ::4], (1, 99))
 
-    moco_img = img.copy()
+    # Reference volume passes through unchanged - every other volume is overwritten below
+    moco_img = np.empty_like(img)
+    moco_img[:, :, :, 0] = img[:, :, :, 0]
     moco_pars = np.zeros([nt, 6])
 
-    # Reference center of mass
-    com_0 = np.array(center_of_mass(img_clip[:, :, :, 0]))
+    # Centers of mass of all volumes from clipped marginal sums along each axis
+    # Clipping applied to blocks of volumes to avoid a second full 4D array
+    com = np.empty([nt, 3])
+    for t0 in range(0, nt, 16):
+        blk = np.clip(img[:, :, :, t0:t0+16], p1, p99)
+        total = np.sum(blk, axis=(0, 1, 2), dtype=np.float64)
+        for dim in range(3):
+            other = tuple(d for d in range(3) if d != dim)
+            marg = np.sum(blk, axis=other, dtype=np.float64)
+            com[t0:t0+16, dim] = np.arange(img.shape[dim]) @ marg / total
+    del blk
 
-    for tc in range(1, nt):
+    # Reference center of mass
+    com_0 = com[0]
 
-        # Center of mass of current volume
-        com_t = np.array(center_of_mass(img_clip[:, :, :, tc]))
+    def _register_volume(tc):
 
         # Center of mass shift required to register current and zeroth volumes
-        com_d = com_0 - com_t
+        com_d = com_0 - com[tc]
 
         # Translate with spline interpolation
         # Use 'nearest neighbor' mode to minimize motion x signal artifacts at image edges
-        moco_img[:, :, :, tc] = shift(img[:, :, :, tc], com_d, mode='nearest')
+        # Skip spline resampling for negligible displacements (typical of a quiescent phantom)
+        if np.max(np.abs(com_d)) < min_shift:
+            moco_img[:, :, :, tc] = img[:, :, :, tc]
+        else:
+            moco_img[:, :, :, tc] = shift(img[:, :, :, tc], com_d, mode='nearest')
 
         # Save CoM translation
         # FSL MCFLIRT convention: [rx, ry, rz, dx, dy, dz]
         moco_pars[tc, 3:6] = com_d * vox_mm
 
+    # Volumes are registered independently and ndimage.shift releases the GIL,
+    # so spread volumes over a thread pool. Each thread writes its own output volume
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(_register_volume, range(1, nt)))
+
     # Create motion corrected Nifti volume
     moco_nii = nb.Nifti1Image(moco_img, img_nii.affine)
 
@@ -97,17 +124,30 @@ def moco_live(img_nii, work_dir):
 
     in_fname = os.path.join(work_dir, 'qc.nii.gz')
     out_stub = os.path.join(work_dir, 'qc_mcf')
-    out_image = out_stub + '.nii.gz'
+
+    # Uncompressed MCFLIRT output - skips gzip in MCFLIRT and gunzip on reload (memory-mapped by nibabel)
+    out_image = out_stub + '.nii'
     out_pars = out_stub + '.par'
 
+    # Work files are only reused when newer than the source series, so a replaced series is
+    # reprocessed without hashing the 4D data
+    src_fname = img_nii.get_filename()
+    src_mtime = os.path.getmtime(src_fname) if src_fname is not None else 0.0
+
+    def _is_current(fname):
+        return os.path.isfile(fname) and os.path.getmtime(fname) >= src_mtime
+
     # Save QC timeseries for MCFLIRT
-    if os.path.isfile(in_fname):
+    # Copy compressed source file as-is when possible - nb.save would gunzip and re-gzip the whole series
+    if _is_current(in_fname):
         print('      * Raw QC series already exists in work directory - skipping')
+    elif src_fname is not None and src_fname.endswith('.nii.gz'):
+        shutil.copyfile(src_fname, in_fname)
     else:
         nb.save(img_nii, in_fname)
 
     # Check for existing moco series in work directory
-    if not os.path.isfile(out_image):
+    if not (_is_current(out_image) and _is_current(out_pars)):
 
         mcflirt_cmd = os.path.join(os.environ['FSLDIR'], 'bin', 'mcflirt')
 
@@ -116,7 +156,8 @@ def moco_live(img_nii, work_dir):
             subprocess.run([mcflirt_cmd,
                             '-in', in_fname,
                             '-out', out_stub,
-                            '-plots'])
+                            '-plots'],
+                           env=dict(os.environ, FSLOUTPUTTYPE='NIFTI'))
         else:
             print('      * MCFLIRT not available - please install FSL and update your environment')
 
@@ -128,7 +169,7 @@ def moco_live(img_nii, work_dir):
     moco_nii = nb.load(out_image)
 
     # Import motion parameter table as a pandas dataframe
-    moco_pars = np.genfromtxt(out_pars)
+    moco_pars = np.loadtxt(out_pars, dtype=np.float64)
 
     return moco_nii, moco_pars
 
@@ -143,27 +184,21 @@ def total_rotation(rot):
     :return: phi_tot: array, total degree rotation angles (nt x 1)
     """
 
-    # Convert axis rotations from degrees to radians
-    rot *= np.pi / 180.0
-
-    nt = rot.shape[0]
-
-    phi_tot = np.zeros([nt,])
-
-    for tc in range(0, nt):
+    # Half-angle sines and cosines of each axis rotation (radians)
+    half = np.radians(rot) / 2.0
+    cx, cy, cz = np.cos(half).T
+    sx, sy, sz = np.sin(half).T
 
-        phix, phiy, phiz = rot[tc, :]
+    # Closed-form quaternion product qx * qy * qz for R = Rx * Ry * Rz
+    # Avoids constructing Rotation objects or rotation matrices
+    w = cx * cy * cz - sx * sy * sz
+    vx = sx * cy * cz + cx * sy * sz
+    vy = cx * sy * cz - sx * cy * sz
+    vz = sx * sy * cz + cx * cy * sz
 
-        # Individual axis rotation matrices
-        Rx = Rotation.from_rotvec([phix, 0, 0])
-        Ry = Rotation.from_rotvec([0, phiy, 0])
-        Rz = Rotation.from_rotvec([0, 0, phiz])
-
-        # Compose rotations
-        Rtot = Rx * Ry * Rz
-
-        # Total rotation from norm of rotation vector (see scipy definition)
-        phi_tot[tc] = np.linalg.norm(Rtot.as_rotvec()) * 180.0 / np.pi
+    # Total rotation angle from the quaternion
+    # atan2 form stays accurate for the near-zero angles typical of QC scans, unlike arccos of the trace
+    phi_tot = np.degrees(2.0 * np.arctan2(np.sqrt(vx * vx + vy * vy + vz * vz), np.abs(w)))
 
     return phi_tot
 
@@ -183,20 +218,21 @@ def moco_postprocess(moco_pars, meta, mode='phantom'):
         "FD_LPF_mm"
     ]
 
-    # Time vector (seconds)
+    # Fill a single preallocated array column-wise - no per-column temporaries or hstack
     TR_s = meta['RepetitionTime']
     nt = moco_pars.shape[0]
-    t = np.arange(0, nt).reshape(-1, 1) * TR_s
+    moco_arr = np.empty((nt, len(column_names)), dtype=np.float64)
+
+    # Time vector (seconds)
+    moco_arr[:, 0] = np.arange(0, nt) * TR_s
+    moco_arr[:, 1:7] = moco_pars
 
     # Calculate FD variants
     if mode == 'phantom':
         # Do not calculate FD and LPF FD for phantom QC
-        fd, fd_lpf = np.zeros((nt, 1)), np.zeros((nt, 1))
+        moco_arr[:, 7:9] = 0.0
     else:
-        fd, fd_lpf = calc_fd(moco_pars, TR_s)
-
-    # Create and fill numpy array
-    moco_arr = np.hstack((t, moco_pars, fd, fd_lpf))
+        moco_arr[:, 7], moco_arr[:, 8] = calc_fd(moco_pars, TR_s)
 
     # Construct dataframe
     moco_df = pd.DataFrame(moco_arr, columns=column_names)
@@ -225,46 +261,33 @@ def calc_fd(mocopars, TR_s):
     functional connectivity. Neuroimage 116866 (2020). doi:10.1016/j.neuroimage.2020.116866
     """
 
-    # Rotations (radians)
-    rx = mocopars[:, 0]
-    ry = mocopars[:, 1]
-    rz = mocopars[:, 2]
-
-    # Translations (mm)
-    tx = mocopars[:, 3]
-    ty = mocopars[:, 4]
-    tz = mocopars[:, 5]
-
-    # Backward differences (forward difference + leading 0)
-
-    drx = np.insert(np.diff(rx), 0, 0)
-    dry = np.insert(np.diff(ry), 0, 0)
-    drz = np.insert(np.diff(rz), 0, 0)
-
-    dtx = np.insert(np.diff(tx), 0, 0)
-    dty = np.insert(np.diff(ty), 0, 0)
-    dtz = np.insert(np.diff(tz), 0, 0)
+    # Absolute backward differences of all six parameters in one pass (forward difference + leading 0)
+    # Columns 0:3 rotations (radians), 3:6 translations (mm)
+    dpars = np.abs(np.diff(mocopars, axis=0, prepend=mocopars[:1, :]))
 
     # Total framewise displacement (Power 2012)
     r_sphere = 50.0  # mm
-    fd = np.abs(dtx) + np.abs(dty) + np.abs(dtz) + r_sphere * (np.abs(drx) + np.abs(dry) + np.abs(drz))
+    fd = np.sum(dpars[:, 3:6], axis=1) + r_sphere * np.sum(dpars[:, 0:3], axis=1)
 
     # Create 0.2 Hz Butterworth LPF for this TR
-    b, a = butterworth_lpf(TR_s)
+    sos = butterworth_lpf(TR_s)
 
     # Apply forward-backward LPF to FD timeseries
-    fd_lpf = signal.filtfilt(b, a, fd, axis=0)
+    fd_lpf = signal.sosfiltfilt(sos, fd, axis=0)
 
-    # Return single-column 2D arrays for hstacking
-    return fd.reshape(-1, 1), fd_lpf.reshape(-1, 1)
+    return fd, fd_lpf
 
 
+# TR is fixed per series and repeats across sessions, so reuse filter designs
+@lru_cache(maxsize=32)
 def butterworth_lpf(TR=1.0):
     """
     Construct a 0.2 Hz low-pass Butterworth filter
 
     param: TR, float
         EPI TR in seconds [1.0 s]
+    return: sos, array
+        Filter second-order sections for signal.sosfiltfilt
     """
 
     # Sampling rate (Hz)
@@ -276,10 +299,10 @@ def butterworth_lpf(TR=1.0):
     # Critical frequency (Hz - same units as fs)
     fc = 0.2
 
-    # Design filter
-    b, a = signal.butter(N, fc, 'low', analog=False, output='ba', fs=fs)
+    # Design filter as second-order sections - better conditioned than ba form at this order
+    sos = signal.butter(N, fc, 'low', analog=False, output='sos', fs=fs)
 
-    return b, a
+    return sos
 
 
 
@@ -37,11 +37,9 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import os
 import json
-import shutil
 import datetime as dt
-import pkg_resources
+from importlib.metadata import version
 
 from reportlab.lib.enums import TA_JUSTIFY
 from reportlab.lib.pagesizes import letter
@@ -54,6 +52,11 @@ from reportlab.platypus import (SimpleDocTemplate,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 
+# Sample stylesheet with an added justified paragraph style
+# Built once per process and shared by every series report - styles are never modified after this
+PSTYLES = getSampleStyleSheet()
+PSTYLES.add(ParagraphStyle(name='Justify', alignment=TA_JUSTIFY))
+
 
 class ReportPDF:
 
@@ -62,15 +65,13 @@ class ReportPDF:
         self._fnames = fnames
         self._meta = meta
         self._metrics = metrics
-        self._version = pkg_resources.require("cbicqc")[0].version
-        self._tmp_report_pdf = os.path.join(fnames['WorkDir'], 'report.pdf')
+        self._version = version('cbicqc')
 
         # Contents - list of flowables to be built into a document
         self._contents = []
 
-        # Add a justified paragraph style
-        self._pstyles = getSampleStyleSheet()
-        self._pstyles.add(ParagraphStyle(name='Justify', alignment=TA_JUSTIFY))
+        # Shared paragraph styles
+        self._pstyles = PSTYLES
 
         self._init_pdf()
         self._add_summary()
@@ -84,8 +85,8 @@ class ReportPDF:
 
     def _init_pdf(self):
 
-        # Create a new PDF document
-        self._doc = SimpleDocTemplate(self._tmp_report_pdf,
+        # Create a new PDF document directly in derivatives
+        self._doc = SimpleDocTemplate(str(self._fnames['ReportPDF']),
                                       pagesize=letter,
                                       rightMargin=0.5 * inch,
                                       leftMargin=0.5 * inch,
@@ -195,97 +196,55 @@ class ReportPDF:
         # Page break
         self._contents.append(PageBreak())
 
-        #
-        # ROI Spatial Mean Timeseries
-        #
-
-        ptext = '<font size=14><b>ROI Spatial Mean Timeseries</b></font>'
-        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        ptext = """
-        <font size=11>
-        These three graphs show the spatial mean signal intensity within the air space, Nyquist ghost and main signal
-        regions of interest (ROIs). A robust least-squares exponential + linear model is used for detrending. 
-        </font>
-        """
-        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        roi_ts_img = Image(self._fnames['ROITimeseries'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
-        self._contents.append(roi_ts_img)
-
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        #
-        # ROI Spatial Mean Power Spectrum
-        #
-
-        ptext = '<font size=14><b>ROI Power Spectra</b></font>'
-        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        ptext = """
-        <font size=11>
-        Power spectrum of the spatial mean signal in each ROI.
-        dB scale referenced to maximum spectral power.
-        </font>
-        """
-        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        roi_ps_img = Image(self._fnames['ROIPowerspec'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
-        self._contents.append(roi_ps_img)
-
-        self._contents.append(Spacer(1, 0.2 * inch))
+        self._add_graph(
+            'ROI Spatial Mean Timeseries',
+            """
+            These three graphs show the spatial mean signal intensity within the air space, Nyquist ghost and main
+            signal regions of interest (ROIs). A robust least-squares exponential + linear model is used for detrending.
+            """,
+            self._fnames['ROITimeseries'])
+
+        self._add_graph(
+            'ROI Power Spectra',
+            """
+            Power spectrum of the spatial mean signal in each ROI.
+            dB scale referenced to maximum spectral power.
+            """,
+            self._fnames['ROIPowerspec'])
 
     def _add_motion_timeseries(self):
 
         # Page break
         self._contents.append(PageBreak())
 
-        #
-        # Motion Parameter Timeseries
-        #
-
-        ptext = '<font size=14><b>Motion Parameter Timeseries</b></font>'
-        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        # Main signal QC specific text
-        ptext = """
-        <font size=11>
-        Displacement and rotation parameter timecourses required
-        to register the center of mass at a given time to the center of mass of the first image. 
-        </font>
-        """
-        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        mo_ts_img = Image(self._fnames['MoparTimeseries'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
-        self._contents.append(mo_ts_img)
-
-        self._contents.append(Spacer(1, 0.2 * inch))
-
-        #
-        # Motion Power Spectra
-        #
-
-        ptext = '<font size=14><b>Motion Power Spectra</b></font>'
+        self._add_graph(
+            'Motion Parameter Timeseries',
+            """
+            Displacement and rotation parameter timecourses required
+            to register the center of mass at a given time to the center of mass of the first image.
+            """,
+            self._fnames['MoparTimeseries'])
+
+        self._add_graph(
+            'Motion Power Spectra',
+            """
+            Power spectrum of the absolute displacement and total rotation timecourses.
+            dB scale referenced to maximum spectral power.
+            """,
+            self._fnames['MoparPowerspec'])
+
+    def _add_graph(self, title, description, img_fname):
+
+        ptext = '<font size=14><b>{}</b></font>'.format(title)
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.2 * inch))
 
-        ptext = """
-        <font size=11>
-        Power spectrum of the absolute displacement and total rotation timecourses.
-        dB scale referenced to maximum spectral power.
-        </font>
-        """
+        ptext = '<font size=11>{}</font>'.format(description)
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.2 * inch))
 
-        mo_ts_img = Image(self._fnames['MoparPowerspec'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
-        self._contents.append(mo_ts_img)
+        graph_img = Image(img_fname, 7.0 * inch, 3.5 * inch, hAlign='LEFT')
+        self._contents.append(graph_img)
 
         self._contents.append(Spacer(1, 0.2 * inch))
 
@@ -335,9 +294,6 @@ class ReportPDF:
 
     def _save_report(self):
 
-        # Copy report PDF to derivatives
-        shutil.copyfile(self._tmp_report_pdf, self._fnames['ReportPDF'])
-
         # Save metrics in derivatives as JSON file
         with open(self._fnames['ReportJSON'], 'w') as fd:
             json.dump(self._metrics, fd, sort_keys=True, indent=4)
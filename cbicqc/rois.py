@@ -30,12 +30,14 @@ SOFTWARE.
 """
 
 import os
-import sys
+import json
 import subprocess
-import pkg_resources
 import nibabel as nb
 import numpy as np
 
+# Package data directory (see package_data in setup.py)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
 
 def register_template(tmean_nii, work_dir, mode='phantom'):
     """
@@ -52,9 +54,8 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
     :return:
     """
 
-    # Save temporal mean image for use by FLIRT
-    tmean_fname = os.path.join(work_dir, 'fixed.nii.gz')
-    nb.save(tmean_nii, tmean_fname)
+    # Temporal mean image for use by FLIRT (uncompressed scratch file)
+    tmean_fname = os.path.join(work_dir, 'fixed.nii')
 
     # Link appropriate template for mode
     # Template labels should be:
@@ -63,14 +64,8 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
     # 2 : signal volume
     if 'phantom' in mode:
         dof = 6
-        template_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'fbirn_template.nii.gz')
-        )
-        labels_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'fbirn_labels.nii.gz')
-        )
+        template_fname = os.path.join(TEMPLATE_DIR, 'fbirn_template.nii.gz')
+        labels_fname = os.path.join(TEMPLATE_DIR, 'fbirn_labels.nii.gz')
     else:
 
         # Temporary fix for scaling issues with partial brain (slab) EPI
@@ -78,22 +73,39 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
         # TODO: Add support for SDC and WB intermediate registration
         dof = 6
 
-        template_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'mni_template_brain.nii.gz')
-        )
-        labels_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'mni_labels.nii.gz')
-        )
+        template_fname = os.path.join(TEMPLATE_DIR, 'mni_template_brain.nii.gz')
+        labels_fname = os.path.join(TEMPLATE_DIR, 'mni_labels.nii.gz')
+
+    # Uncompressed FLIRT outputs - skips gzip in FLIRT and gunzip when the labels are reloaded
+    template_xfm_fname = os.path.join(work_dir, 'template_xfm.nii')
+    labels_xfm_fname = os.path.join(work_dir, 'labels_xfm.nii')
+    flirt_env = dict(os.environ, FSLOUTPUTTYPE='NIFTI')
+
+    # Sidecar recording the template, labels and DOF used for labels_xfm.nii
+    # Phantom and live runs can share a work directory, so the temporal mean alone does not identify a registration
+    xfm_info_fname = os.path.join(work_dir, 'labels_xfm.json')
+    xfm_info = {'Template': template_fname, 'Labels': labels_fname, 'DOF': dof}
 
-    template_xfm_fname = os.path.join(work_dir, 'template_xfm.nii.gz')
-    labels_xfm_fname = os.path.join(work_dir, 'labels_xfm.nii.gz')
+    # Reuse an earlier registration of an identical temporal mean with the same template in this work directory
+    if (os.path.isfile(labels_xfm_fname) and same_xfm_info(xfm_info, xfm_info_fname) and
+            same_image(tmean_nii, tmean_fname) and
+            os.path.getmtime(labels_xfm_fname) >= os.path.getmtime(tmean_fname)):
+        print('      * Template already registered to this temporal mean - skipping')
+        return nb.load(labels_xfm_fname)
+
+    # Invalidate any previous sidecar until this registration completes
+    if os.path.isfile(xfm_info_fname):
+        os.remove(xfm_info_fname)
+
+    nb.save(tmean_nii, tmean_fname)
 
     fsl_dir = os.environ['FSLDIR']
     flirt_cmd = os.path.join(fsl_dir, 'bin', 'flirt')
     xfm_fname = os.path.join(work_dir, 'xfm.mat')
 
+    # FLIRT console output is logged in the work directory rather than passed through Python's streams
+    log_fname = os.path.join(work_dir, 'flirt.log')
+
     # Run FLIRT registration
     print('      Registering template to subject ({} DOF)'.format(dof))
     cmd = [flirt_cmd,
@@ -103,7 +115,10 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
            '-dof', str(dof),
            '-omat', xfm_fname,
     ]
-    subprocess.run(cmd, stderr=sys.stderr, stdout=sys.stdout)
+    with open(log_fname, 'w') as log_fd:
+        result = subprocess.run(cmd, stdout=log_fd, stderr=subprocess.STDOUT, env=flirt_env)
+    if result.returncode != 0:
+        raise RuntimeError('FLIRT registration failed - see {}'.format(log_fname))
 
     # Apply resulting transform to label image
     print('      Resampling labels to subject space')
@@ -115,7 +130,13 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
            '-init', xfm_fname,
            '-interp', 'nearestneighbour',
     ]
-    subprocess.run(cmd, stderr=sys.stderr, stdout=sys.stdout)
+    with open(log_fname, 'a') as log_fd:
+        result = subprocess.run(cmd, stdout=log_fd, stderr=subprocess.STDOUT, env=flirt_env)
+    if result.returncode != 0:
+        raise RuntimeError('FLIRT label resampling failed - see {}'.format(log_fname))
+
+    with open(xfm_info_fname, 'w') as fd:
+        json.dump(xfm_info, fd, indent=4)
 
     # Load labels transformed to subject space
     print('      Loading resampled labels')
@@ -124,6 +145,53 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
     return labels_nii
 
 
+def same_xfm_info(xfm_info, fname):
+    """
+    Check whether a registration sidecar matches the requested template, labels and DOF
+
+    :param xfm_info: dict,
+        Template and labels filenames and registration DOF
+    :param fname: str,
+        Path to previously saved sidecar JSON
+    :return: bool
+    """
+
+    if not os.path.isfile(fname):
+        return False
+
+    try:
+        with open(fname, 'r') as fd:
+            prev_info = json.load(fd)
+    except (OSError, ValueError):
+        return False
+
+    return prev_info == xfm_info
+
+
+def same_image(img_nii, fname):
+    """
+    Check whether an image file holds the same voxel data and geometry as an image object
+
+    :param img_nii: Nifti object,
+        Image to compare
+    :param fname: str,
+        Path to previously saved image
+    :return: bool
+    """
+
+    if not os.path.isfile(fname):
+        return False
+
+    prev_nii = nb.load(fname)
+    if prev_nii.shape != img_nii.shape or not np.allclose(prev_nii.affine, img_nii.affine):
+        return False
+
+    # Compare at the saved precision, without filling either image's data cache
+    dtype = prev_nii.get_data_dtype()
+    prev_img = np.asanyarray(prev_nii.dataobj)
+    return np.array_equal(prev_img, np.asanyarray(img_nii.dataobj).astype(dtype, copy=False))
+
+
 def make_rois(labels_nii):
     """
     Create ROI masks for unique air, ghost and signal volumes
@@ -134,30 +202,41 @@ def make_rois(labels_nii):
         Integer ROI image include air and Nyquist ghost
     """
 
-    # Extract integer-valued label image
-    labels_img = labels_nii.get_fdata().astype(np.uint)
+    # Label image in its stored dtype - no float64 conversion or integer copy
+    labels_img = np.asanyarray(labels_nii.dataobj)
 
-    buffer_mask = (labels_img > 0).astype(np.uint8)
-    signal_mask = (labels_img > 1).astype(np.uint8)
+    # Boolean masks throughout - no integer mask arithmetic or temporaries
+    # Thresholds match integer truncation of the labels for any stored dtype
+    buffer_mask = labels_img >= 1
+    signal_mask = labels_img >= 2
 
-    # Create Nyquist mask by rolling signal mask by FOVy/2
-    ny = signal_mask.shape[1]
-    nyquist_mask = np.roll(signal_mask, int(ny / 2), axis=1)
+    # Nyquist ghost and air space both lie outside the buffered signal volume
+    outside_mask = ~buffer_mask
 
-    # Remove buffer mask from Nyquist ghost mask
-    nyquist_only_mask = nyquist_mask * (1 - buffer_mask)
+    # Nyquist ghost is the signal mask rolled by FOVy/2, less the buffer mask
+    # Combine the two halves of the roll as slice views instead of materializing np.roll
+    ny = signal_mask.shape[1]
+    hy = int(ny / 2)
+    nyquist_only_mask = np.empty_like(outside_mask)
+    np.logical_and(signal_mask[:, :ny-hy], outside_mask[:, hy:], out=nyquist_only_mask[:, hy:])
+    np.logical_and(signal_mask[:, ny-hy:], outside_mask[:, :hy], out=nyquist_only_mask[:, :hy])
 
     # Create air mask
-    air_mask = (1 - buffer_mask) - nyquist_only_mask
+    air_mask = outside_mask & ~nyquist_only_mask
 
     # Finally merge all masks into an ROI label file
+    # Masks are disjoint, so fill labels directly into a uint8 volume
     # Undefined       = 0
     # Air Space       = 1
     # Nyquist Ghost   = 2
     # Signal          = 3
-    rois = air_mask + 2 * nyquist_only_mask + 3 * signal_mask
+    rois = np.zeros(labels_img.shape, dtype=np.uint8)
+    rois[air_mask] = 1
+    rois[nyquist_only_mask] = 2
+    rois[signal_mask] = 3
 
-    # Wrap image in a Nifti object
+    # Wrap image in a Nifti object, storing labels as uint8
     rois_nii = nb.Nifti1Image(rois, labels_nii.affine)
+    rois_nii.set_data_dtype(np.uint8)
 
     return rois_nii
\ No newline at end of file
@@ -33,10 +33,13 @@ import os
 import shutil
 import tempfile
 import numpy as np
-from datetime import datetime
+import pandas as pd
+from datetime import datetime, date
 
+# Headless, file-only plotting - select Agg before pyplot to skip GUI backend probing
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
@@ -71,8 +74,7 @@ class Summarize:
         register_matplotlib_converters()
 
         # Add plot-friendly Date column
-        metrics_df['Date'] = [datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S.%f')
-                              for dt in metrics_df['AcquisitionDateTime'].values]
+        metrics_df['Date'] = pd.to_datetime(metrics_df['AcquisitionDateTime'], format='%Y-%m-%dT%H:%M:%S.%f')
 
         # Metrics of interest to plot and save to CSV
         self._metric_names = [
@@ -198,19 +200,29 @@ class Summarize:
         # Output PNG filename
         png_fname = os.path.join(self._work_dir, 'metric_trends.png')
 
-        # Setup plot grid
-        plt.figure(figsize=(14, 18))
-        gs = gridspec.GridSpec(n_metrics, 2, width_ratios=[3, 1])
+        # Setup plot grid - trend and histogram axes for each metric created in one call
+        fig, axs = plt.subplots(n_metrics, 2,
+                                figsize=(14, 18),
+                                gridspec_kw={'width_ratios': [3, 1]},
+                                sharey='row')
+
+        # Plot time window shared by all metrics
+        t1 = pd.Timestamp(date.today())
+        t0 = t1 - pd.DateOffset(months=self._past_months)
+
+        # 5th, 50th and 95th percentiles of all metrics in one call (3 x n_metrics)
+        pcts = np.percentile(self._metrics_df[self._metric_names].values, (5, 50, 95), axis=0)
 
         # Fill each of the subplots
         for mc, m_name in enumerate(self._metric_names):
-            metric_trend_plot(mc, m_name, self._metrics_df, gridspec=gs, past_months=self._past_months)
+            metric_trend_plot(axs[mc], m_name, self._metrics_df, t_range=(t0, t1), pcts=pcts[:, mc])
 
         # Tweak subplot margins and spacing
-        plt.tight_layout()
+        fig.tight_layout()
 
         # Save plot to file
-        plt.savefig(png_fname, dpi=300)
+        fig.savefig(png_fname, dpi=300, pil_kwargs={'compress_level': 1})
+        plt.close(fig)
 
         return png_fname
 
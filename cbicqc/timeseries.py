@@ -31,24 +31,51 @@ import nibabel as nb
 
 def temporal_mean_sd(qc_moco_nii):
 
-    qc = qc_moco_nii.get_fdata()
+    # Single precision 4D data, double precision temporal accumulators
+    qc = qc_moco_nii.get_fdata(dtype=np.float32)
+
+    nz = qc.shape[2]
+    tmean = np.empty(qc.shape[:3])
+    tsd = np.empty(qc.shape[:3])
+
+    # Reduce in slabs of slices so the squared deviation temporary is slab-sized
+    # rather than a full-series copy
+    for z0 in range(0, nz, 4):
+
+        blk = qc[:, :, z0:z0+4, :]
+
+        # Temporal mean of slab timeseries
+        blk_mean = np.mean(blk, axis=3, dtype=np.float64)
+
+        # Temporal SD reusing the mean above (np.std would recompute it)
+        # Squared deviations formed in place in a single float32 temporary
+        dev = blk - blk_mean.astype(np.float32)[..., np.newaxis]
+        dev *= dev
+
+        tmean[:, :, z0:z0+4] = blk_mean
+        tsd[:, :, z0:z0+4] = np.sqrt(np.mean(dev, axis=3, dtype=np.float64))
 
-    # Temporal mean of 4D timeseries
-    tmean = np.mean(qc, axis=3)
-    tsd = np.std(qc, axis=3)
     tsfnr = tmean / (tsd + 1e-30)
 
-    tmean_nii = nb.Nifti1Image(tmean, qc_moco_nii.affine)
-    tsd_nii = nb.Nifti1Image(tsd, qc_moco_nii.affine)
-    tsfnr_nii = nb.Nifti1Image(tsfnr, qc_moco_nii.affine)
+    # Derive one 3D single precision header from the source - each image takes its own copy
+    hdr = qc_moco_nii.header.copy()
+    hdr.set_data_shape(tmean.shape)
+    hdr.set_data_dtype(np.float32)
+
+    tmean_nii = nb.Nifti1Image(tmean, qc_moco_nii.affine, hdr)
+    tsd_nii = nb.Nifti1Image(tsd, qc_moco_nii.affine, hdr)
+    tsfnr_nii = nb.Nifti1Image(tsfnr, qc_moco_nii.affine, hdr)
 
     return tmean_nii, tsd_nii, tsfnr_nii
 
 
 def extract_timeseries(qc_moco_nii, rois_nii):
 
-    rois = rois_nii.get_fdata()
-    s = qc_moco_nii.get_fdata()
+    # Integer ROI labels used as-is - no float64 copy needed for label comparisons
+    rois = np.asanyarray(rois_nii.dataobj)
+
+    # Same dtype as temporal_mean_sd to reuse the cached image array
+    s = qc_moco_nii.get_fdata(dtype=np.float32)
 
     # Number of time points
     nt = s.shape[3]
@@ -65,10 +92,11 @@ def extract_timeseries(qc_moco_nii, rois_nii):
     s_mean_t = np.zeros([nl, nt])
 
     for lc in range(0, nl):
-        mask = np.array(rois == labels[lc])
-        for tc in range(0, nt):
-            s_t = s[:, :, :, tc]
-            s_mean_t[lc, tc] = np.mean(s_t[mask])
+
+        # Gather ROI voxel timeseries in one indexing pass (n_vox x nt) and average over voxels
+        # Accumulate in double precision - single precision sums over many voxels lose accuracy
+        mask = rois == labels[lc]
+        s_mean_t[lc, :] = np.mean(s[mask], axis=0, dtype=np.float64)
 
     return s_mean_t
 
@@ -83,13 +111,16 @@ def detrend_timeseries(s_mean_t):
     nl, nt = s_mean_t.shape
 
     # Time vector
-    t = np.arange(0, nt)
+    t = np.arange(0, nt, dtype=np.float64)
 
-    s_detrend_t = np.zeros_like(s_mean_t)
-    s_fit_t = np.zeros_like(s_mean_t)
+    s_detrend_t = np.empty_like(s_mean_t)
+    s_fit_t = np.empty_like(s_mean_t)
 
     fit_results = []
 
+    # Initial parameter estimates for all ROIs from a single fixed tau grid search
+    x0_all = explin_grid_fit(s_mean_t)
+
     # Loop over each label ROI mean timeseries
     for lc in range(0, nl):
 
@@ -99,28 +130,70 @@ def detrend_timeseries(s_mean_t):
         s_rng = s_max - s_min
 
         # [Exp Amp, Exp Tau, Linear slope, Offset]
-        x0 = [s_rng, 1, -s_rng / float(nt), s_mean]
+        # Clamp grid search estimate to the fit bounds
+        x0 = x0_all[lc, :]
+        x0[0] = np.clip(x0[0], 0.0, 2.0 * s_rng)
+        x0[3] = max(x0[3], 0.0)
         bounds = ([0.0, 0, -np.inf, 0],
                   [2.0 * s_rng, nt, np.inf, np.inf])
 
         # Robust non-linear curve fit (Huber loss function)
+        # Analytic Jacobian avoids finite difference model evaluations
         result = least_squares(explin, x0,
+                               jac=explin_jac,
                                method='trf',
                                loss='huber',
                                bounds=bounds,
                                args=(t, s_t))
 
-        # Fitted curve - note sign change from residual definition
-        s_fit_t[lc, :] = -explin(result.x, t, 0)
+        # Fitted curve from data and residuals (residual = y(t) - y_fit(t))
+        np.subtract(s_t, result.fun, out=s_fit_t[lc, :])
 
-        # Detrended timeseries = y_fit(t) - y(t) + mean(y(t))
-        s_detrend_t[lc, :] = result.fun + s_mean
+        # Detrended timeseries = y(t) - y_fit(t) + mean(y(t))
+        np.add(result.fun, s_mean, out=s_detrend_t[lc, :])
 
         fit_results.append(result)
 
     return fit_results, s_detrend_t, s_fit_t
 
 
+def explin_grid_fit(s_mean_t, n_tau=32):
+    """
+    Fast exponential + linear model estimates for all ROI timeseries at once
+    Amplitude, slope and offset are solved by linear least squares over a fixed
+    grid of time constants, keeping the best tau for each ROI
+
+    :param s_mean_t: array, spatial mean ROI timeseries (n_labels x n_timepoints)
+    :param n_tau: int, number of time constants in the search grid
+    :return x0: array, model parameters for each ROI (n_labels x 4)
+    """
+
+    nl, nt = s_mean_t.shape
+
+    t = np.arange(0, nt, dtype=np.float64)
+    y = s_mean_t.T
+
+    sse_best = np.full(nl, np.inf)
+    x0 = np.zeros([nl, 4])
+
+    for tau in np.geomspace(1.0, nt, n_tau):
+
+        # Design matrix [exp(-t/tau), t, 1] shared by all ROIs
+        a = np.column_stack([np.exp(-t / tau), t, np.ones(nt)])
+        beta = np.linalg.lstsq(a, y, rcond=None)[0]
+
+        sse = np.sum((y - a @ beta) ** 2, axis=0)
+        better = sse < sse_best
+
+        sse_best[better] = sse[better]
+        x0[better, 0] = beta[0, better]
+        x0[better, 1] = tau
+        x0[better, 2] = beta[1, better]
+        x0[better, 3] = beta[2, better]
+
+    return x0
+
+
 def explin(x, t, y):
     """
     Exponential + linear trend model
@@ -135,6 +208,34 @@ def explin(x, t, y):
     :return: array, residuals
     """
 
-    y_fit = x[0] * np.exp(-t / x[1]) + x[2] * t + x[3]
+    # Residual y - (a * exp(-t/tau) + b * t + c) accumulated in one buffer
+    # Called for every least_squares iteration, so avoid per-term temporaries
+    r = np.divide(t, -x[1])
+    np.exp(r, out=r)
+    r *= -x[0]
+    r += y
+    r -= x[3]
+    r -= x[2] * t
+
+    return r
+
+
+def explin_jac(x, t, y):
+    """
+    Analytic Jacobian of the exponential + linear model residuals
+
+    :param x: list, parameters (see explin)
+    :param t: array, time vector
+    :param y: array, data (unused)
+    :return: array, Jacobian of residuals (nt x 4)
+    """
+
+    e = np.exp(-t / x[1])
+
+    jac = np.empty([t.size, 4])
+    jac[:, 0] = -e
+    jac[:, 1] = -x[0] * t * e / (x[1] * x[1])
+    jac[:, 2] = -t
+    jac[:, 3] = -1.0
 
-    return y - y_fit
+    return jac